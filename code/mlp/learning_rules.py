@@ -4,8 +4,163 @@
 This module contains classes implementing gradient based learning rules.
 """
 
+import math
 import numpy as np
 
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import cupy
+    CUPY_AVAILABLE = True
+except ImportError:
+    CUPY_AVAILABLE = False
+
+# Squared stabilising constant added to the second moment estimates *inside*
+# the square root in the RMSProp and Adam denominators, i.e. updates are
+# scaled by 1 / sqrt(v + 1e-16) rather than 1 / (sqrt(v) + 1e-8). This gives
+# a single reciprocal square root per element, which compilers map to fast
+# rsqrt instructions, rather than a dependent sqrt-add-divide chain. The two
+# forms agree closely for v >> 1e-16, agree exactly at v = 0 and in between
+# differ by at most a factor of sqrt(2) (reached at v = 1e-16).
+EPS_SQ = 1e-16
+
+
+if NUMBA_AVAILABLE:
+
+    # The update kernels are serial loops which release the GIL while running
+    # so that optimiser steps issued from separate Python threads can execute
+    # concurrently. They are deliberately not compiled with `parallel=True` as
+    # Numba's default workqueue threading layer is not thread-safe.
+    @njit(fastmath=True, cache=True, nogil=True)
+    def _rmsprop_step(param, rms, grad, learning_rate, decay_rate, eps_sq):
+        """Fused single-pass RMSProp update over flat contiguous arrays."""
+        for i in range(param.size):
+            r = decay_rate * rms[i] + (1. - decay_rate) * grad[i] ** 2
+            rms[i] = r
+            param[i] -= learning_rate * grad[i] * (1. / math.sqrt(r + eps_sq))
+
+    @njit(fastmath=True, cache=True, nogil=True)
+    def _adam_step(param, mom_1, mom_2, grad, step_size, param_scale,
+                   first_decay_rate, second_decay_rate, update_second,
+                   eps_sq):
+        """Fused single-pass Adam update over flat contiguous arrays.
+
+        The bias correction for the moment estimates is expected to have been
+        folded in to `step_size` by the caller. Parameters are multiplied by
+        `param_scale` before the update is applied, which implements
+        decoupled weight decay when less than one. If `update_second` is
+        false the second moment estimates are only read, not updated.
+        """
+        for i in range(param.size):
+            m = first_decay_rate * mom_1[i] + (1. - first_decay_rate) * grad[i]
+            mom_1[i] = m
+            if update_second:
+                v = (second_decay_rate * mom_2[i] +
+                     (1. - second_decay_rate) * grad[i] ** 2)
+                mom_2[i] = v
+            else:
+                v = mom_2[i]
+            param[i] = (param_scale * param[i] -
+                        step_size * m * (1. / math.sqrt(v + eps_sq)))
+
+
+def _has_kernel_dtype(arrays):
+    """Whether all arrays have a floating point type the kernels support.
+
+    Numba has no CPU support for float16 so only single and double precision
+    arrays can be passed to the compiled kernels.
+    """
+    return all(array.dtype in (np.float32, np.float64) for array in arrays)
+
+
+def _use_fused_kernels(params):
+    """Whether the compiled update kernels can be applied to `params`.
+
+    The kernels operate on flat views of the parameter arrays so these need to
+    be C-contiguous NumPy arrays for the updates to be applied in-place.
+    """
+    return NUMBA_AVAILABLE and _has_kernel_dtype(params) and all(
+        isinstance(param, np.ndarray) and param.flags.c_contiguous
+        for param in params)
+
+
+def _get_array_module(arrays):
+    """Returns the array module (NumPy or CuPy) for a list of arrays.
+
+    Learning rule state is allocated with and updated using this module so
+    that parameters stored as CuPy arrays are optimised on the GPU.
+    """
+    if CUPY_AVAILABLE:
+        return cupy.get_array_module(*arrays)
+    return np
+
+
+def _flat(array):
+    """Returns a flat contiguous copy (or view where possible) of an array."""
+    return np.ascontiguousarray(array).reshape(-1)
+
+
+def _result_dtype(params, dtype=None):
+    """Returns `dtype` if set otherwise the common type of `params`."""
+    if dtype is not None:
+        return dtype
+    if len(params) == 0:
+        return np.float64
+    return np.result_type(*[param.dtype for param in params])
+
+
+def _flat_zeros_like(params, dtype=None):
+    """Allocates a single zeroed buffer covering a list of parameters.
+
+    Keeping each kind of learning rule state in one contiguous buffer means
+    it can be reset with a single call rather than one call per parameter.
+
+    Args:
+        params: List of parameter arrays.
+        dtype: Data type of the buffer. Defaults to the common type of the
+            arrays in `params`.
+
+    Returns:
+        Tuple `(flat, views)` with `flat` a one-dimensional array with one
+        element per parameter element and `views` a list of views into
+        `flat` with shapes matching the corresponding arrays in `params`.
+    """
+    xp = _get_array_module(params)
+    flat = xp.zeros(sum(param.size for param in params),
+                    _result_dtype(params, dtype))
+    views = []
+    offset = 0
+    for param in params:
+        views.append(flat[offset:offset + param.size].reshape(param.shape))
+        offset += param.size
+    return flat, views
+
+
+def _scratch_like(params, dtype=None):
+    """Allocates a scratch buffer shared between a list of parameters.
+
+    The buffer is sized for the largest parameter and all of the returned
+    views alias its start, so it can only be used for one parameter at a
+    time.
+
+    Args:
+        params: List of parameter arrays.
+        dtype: Data type of the buffer. Defaults to the common type of the
+            arrays in `params`.
+
+    Returns:
+        List of views into the buffer with shapes matching the corresponding
+        arrays in `params`.
+    """
+    xp = _get_array_module(params)
+    buffer = xp.empty(max([param.size for param in params] + [0]),
+                      _result_dtype(params, dtype))
+    return [buffer[:param.size].reshape(param.shape) for param in params]
+
 
 class GradientDescentLearningRule(object):
     """Simple (stochastic) gradient descent learning rule.
@@ -49,6 +204,7 @@ class GradientDescentLearningRule(object):
                 update.
         """
         self.params = params
+        self.xp = _get_array_module(params)
 
     def reset(self):
         """Resets any additional state variables to their intial values.
@@ -133,17 +289,14 @@ class MomentumLearningRule(GradientDescentLearningRule):
                 update.
         """
         super(MomentumLearningRule, self).initialise(params)
-        self.moms = []
-        for param in self.params:
-            self.moms.append(np.zeros_like(param))
+        self._flat_mom, self.moms = _flat_zeros_like(self.params)
 
     def reset(self):
         """Resets any additional state variables to their intial values.
 
         For this learning rule this corresponds to zeroing all the momenta.
         """
-        for mom in zip(self.moms):
-            mom *= 0.
+        self._flat_mom.fill(0.)
 
     def update_params(self, grads_wrt_params):
         """Applies a single update to all parameters.
@@ -165,24 +318,44 @@ class MomentumLearningRule(GradientDescentLearningRule):
 class RMSPropLearningRule(GradientDescentLearningRule):
     def __init__(self, learning_rate=1e-3, decay_rate=0.9):
         super(RMSPropLearningRule, self).__init__(learning_rate)
-        self.rms = []
+        self._flat_rms, self.rms = _flat_zeros_like([])
         assert 0. <= decay_rate <= 1., ('decay_rate should be in the range [0, 1].')
         self.decay_rate = decay_rate
 
     def initialise(self, params):
         super(RMSPropLearningRule, self).initialise(params)
-        self.rms = []
-        for param in self.params:
-            self.rms.append(np.zeros_like(param))
+        self._flat_rms, self.rms = _flat_zeros_like(self.params)
+        self._use_kernel = _use_fused_kernels(self.params)
+        self._scratch = None
 
     def reset(self):
-        for r in zip(self.rms):
-            r *= 0.
+        self._flat_rms.fill(0.)
 
     def update_params(self, grads_wrt_params):
-        for i in range(len(self.params)):
-            self.rms[i] = self.decay_rate * self.rms[i] + (1. - self.decay_rate) * np.square(grads_wrt_params[i])
-            self.params[i] -= grads_wrt_params[i] * self.learning_rate / (np.sqrt(self.rms[i]) + 1e-8)
+        learning_rate, decay_rate = self.learning_rate, self.decay_rate
+        if self._use_kernel and _has_kernel_dtype(grads_wrt_params):
+            for param, rms, grad in zip(
+                    self.params, self.rms, grads_wrt_params):
+                _rmsprop_step(param.reshape(-1), rms.reshape(-1), _flat(grad),
+                              learning_rate, decay_rate, EPS_SQ)
+            return
+        # All operations write into the preallocated state and scratch
+        # buffers so no temporary arrays are created on each update.
+        if self._scratch is None:
+            self._scratch = _scratch_like(self.params)
+        one_minus_decay_rate = 1. - decay_rate
+        xp = self.xp
+        for param, rms, scratch, grad in zip(
+                self.params, self.rms, self._scratch, grads_wrt_params):
+            xp.multiply(grad, grad, out=scratch)
+            scratch *= one_minus_decay_rate
+            rms *= decay_rate
+            rms += scratch
+            xp.add(rms, EPS_SQ, out=scratch)
+            xp.sqrt(scratch, out=scratch)
+            xp.divide(grad, scratch, out=scratch)
+            scratch *= learning_rate
+            param -= scratch
 
 
 # class RMSPropLearningRule(GradientDescentLearningRule):
@@ -210,32 +383,146 @@ class RMSPropLearningRule(GradientDescentLearningRule):
 
 
 class AdamLearningRule(GradientDescentLearningRule):
-    def __init__(self, learning_rate=1e-3, first_decay_rate=0.9, second_decay_rate=0.999):
+    def __init__(self, learning_rate=1e-3, first_decay_rate=0.9, second_decay_rate=0.999,
+                 second_moment_dtype=None, weight_decay=0.,
+                 second_moment_interval=1):
+        """Creates a new learning rule object.
+
+        Args:
+            learning_rate: A postive scalar to scale gradient updates to the
+                parameters by.
+            first_decay_rate: A scalar in the range [0, 1) determining the
+                decay rate of the moving average of the gradients.
+            second_decay_rate: A scalar in the range [0, 1) determining the
+                decay rate of the moving average of the squared gradients.
+            second_moment_dtype: Type to store the second moment estimates
+                with, e.g. np.float16 to halve their memory use. As these are
+                only used through their square root the reduced precision has
+                little effect on the updates. If None the estimates have the
+                same type as the parameters.
+            weight_decay: A non-negative scalar. Each update the parameters
+                are shrunk by a factor (1 - learning_rate * weight_decay)
+                directly (AdamW style decoupled weight decay) rather than a
+                penalty gradient being added which would be rescaled by the
+                second moment estimates.
+            second_moment_interval: A positive integer k. If k > 1 the second
+                moment estimates are only updated every k steps, with the
+                current squared gradient weighted for all the steps since the
+                last update, and are only read on other steps. This
+                approximates the exact moving average when
+                second_decay_rate ** k is close to one. For the first
+                1 / (1 - second_decay_rate) steps the estimates are updated
+                every step.
+        """
         super(AdamLearningRule, self).__init__(learning_rate)
-        self.first_moment = []
-        self.second_moment = []
-        assert 0. <= first_decay_rate <= 1., ('decay_rate should be in the range [0, 1].')
-        assert 0. <= second_decay_rate <= 1., ('square_decay_rate should be in the range [0, 1].')
+        self._flat_first_moment, self.first_moment = _flat_zeros_like([])
+        self._flat_second_moment, self.second_moment = _flat_zeros_like([])
+        # Decay rates of exactly one are excluded as the bias correction of
+        # the moment estimates would then be undefined.
+        assert 0. <= first_decay_rate < 1., ('decay_rate should be in the range [0, 1).')
+        assert 0. <= second_decay_rate < 1., ('square_decay_rate should be in the range [0, 1).')
+        assert weight_decay >= 0., 'weight_decay should be non-negative.'
+        assert (isinstance(second_moment_interval, int) and
+                second_moment_interval >= 1), (
+            'second_moment_interval should be a positive integer.')
         self.first_decay_rate = first_decay_rate
         self.second_decay_rate = second_decay_rate
+        self.second_moment_dtype = second_moment_dtype
+        self.weight_decay = weight_decay
+        self.second_moment_interval = second_moment_interval
 
     def initialise(self, params):
         super(AdamLearningRule, self).initialise(params)
-        self.first_moment = []
-        self.second_moment = []
-        for param in self.params:
-            self.first_moment.append(np.zeros_like(param))
-            self.second_moment.append(np.zeros_like(param))
+        self._flat_first_moment, self.first_moment = (
+            _flat_zeros_like(self.params))
+        self._flat_second_moment, self.second_moment = (
+            _flat_zeros_like(self.params, self.second_moment_dtype))
+        self._use_kernel = (
+            _use_fused_kernels(self.params) and
+            self._flat_second_moment.dtype == self._flat_first_moment.dtype)
+        self._scratch = None
+        self._t = 0
+        self._t_second = 0
 
     def reset(self):
-        for r in zip(self.first_moment):
-            r *= 0.
-        for r in zip(self.second_moment):
-            r *= 0.
+        self._flat_first_moment.fill(0.)
+        self._flat_second_moment.fill(0.)
+        self._t = 0
+        self._t_second = 0
+
+    def _step_size(self):
+        """Learning rate scaled to correct the bias of the moment estimates.
+
+        The moment estimates are biased towards their zero initialisation
+        for early updates. Rather than correcting each element, both
+        correction factors are folded in to a single scalar step size. The
+        second moment correction uses the step the estimates were last
+        updated on.
+        """
+        return (
+            self.learning_rate *
+            math.sqrt(1. - self.second_decay_rate ** self._t_second) /
+            (1. - self.first_decay_rate ** self._t))
 
     def update_params(self, grads_wrt_params):
-        for i in range(len(self.params)):
-            self.first_moment[i] = self.first_decay_rate * self.first_moment[i] + (1. - self.first_decay_rate) * grads_wrt_params[i]
-            self.second_moment[i] = self.second_decay_rate * self.second_moment[i] + (1. - self.second_decay_rate) * np.square(
-                grads_wrt_params[i])
-            self.params[i] -= self.learning_rate * self.first_moment[i] / (np.sqrt(self.second_moment[i]) + 1e-8)
+        first_decay_rate = self.first_decay_rate
+        second_decay_rate = self.second_decay_rate
+        self._t += 1
+        steps_since_update = self._t - self._t_second
+        update_second = (
+            steps_since_update >= self.second_moment_interval or
+            self._t * (1. - second_decay_rate) < 1. or self._t_second == 0)
+        if update_second:
+            second_decay_rate = second_decay_rate ** steps_since_update
+            self._t_second = self._t
+        step_size = self._step_size()
+        param_scale = 1. - self.learning_rate * self.weight_decay
+        if self._use_kernel and _has_kernel_dtype(grads_wrt_params):
+            for param, mom_1, mom_2, grad in zip(
+                    self.params, self.first_moment, self.second_moment,
+                    grads_wrt_params):
+                _adam_step(param.reshape(-1), mom_1.reshape(-1),
+                           mom_2.reshape(-1), _flat(grad), step_size,
+                           param_scale, first_decay_rate, second_decay_rate,
+                           update_second, EPS_SQ)
+            return
+        if self._scratch is None:
+            self._scratch = _scratch_like(self.params)
+            # Reduced precision second moments are updated at full precision
+            # in a separate scratch buffer and only rounded when stored.
+            if (self._flat_second_moment.dtype !=
+                    self._flat_first_moment.dtype):
+                self._var_scratch = _scratch_like(self.params)
+            else:
+                self._var_scratch = [None] * len(self.params)
+        one_minus_first_decay_rate = 1. - first_decay_rate
+        xp = self.xp
+        for param, mom_1, mom_2, scratch, var_scratch, grad in zip(
+                self.params, self.first_moment, self.second_moment,
+                self._scratch, self._var_scratch, grads_wrt_params):
+            xp.multiply(grad, one_minus_first_decay_rate, out=scratch)
+            mom_1 *= first_decay_rate
+            mom_1 += scratch
+            if not update_second:
+                var = mom_2
+            elif var_scratch is None:
+                xp.multiply(grad, grad, out=scratch)
+                scratch *= 1. - second_decay_rate
+                mom_2 *= second_decay_rate
+                mom_2 += scratch
+                var = mom_2
+            else:
+                xp.multiply(grad, grad, out=scratch)
+                scratch *= 1. - second_decay_rate
+                xp.multiply(mom_2, second_decay_rate, out=var_scratch,
+                            dtype=var_scratch.dtype)
+                var_scratch += scratch
+                mom_2[...] = var_scratch
+                var = var_scratch
+            xp.add(var, EPS_SQ, out=scratch, dtype=scratch.dtype)
+            xp.sqrt(scratch, out=scratch)
+            xp.divide(mom_1, scratch, out=scratch)
+            scratch *= step_size
+            if param_scale != 1.:
+                param *= param_scale
+            param -= scratch
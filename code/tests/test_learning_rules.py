@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Tests for the learning rules in `mlp.learning_rules`."""
+
+import numpy as np
+import pytest
+
+from mlp.learning_rules import RMSPropLearningRule, AdamLearningRule
+
+
+@pytest.mark.parametrize('rule_class', [RMSPropLearningRule, AdamLearningRule])
+def test_float16_params_updated_without_kernels(rule_class):
+    """Float16 parameters (unsupported by Numba) use the NumPy update."""
+    pytest.importorskip('numba')
+    params = [np.ones((3, 2), dtype=np.float16)]
+    rule = rule_class(learning_rate=1e-2)
+    rule.initialise(params)
+    assert not rule._use_kernel
+    rule.update_params([np.ones((3, 2), dtype=np.float16)])
+    assert params[0].dtype == np.float16
+    assert np.all(params[0] < 1.)
+
+
+@pytest.mark.parametrize('rule_class', [RMSPropLearningRule, AdamLearningRule])
+def test_float16_grads_match_float32_grads(rule_class):
+    """Float16 gradients fall back to the NumPy update with the same result."""
+    pytest.importorskip('numba')
+    grad = np.linspace(-1., 1., 6, dtype=np.float16).reshape(3, 2)
+    results = []
+    for grad_dtype in (np.float32, np.float16):
+        params = [np.ones((3, 2), dtype=np.float32)]
+        rule = rule_class(learning_rate=1e-2)
+        rule.initialise(params)
+        rule.update_params([grad.astype(grad_dtype)])
+        results.append(params[0])
+    assert np.allclose(results[0], results[1], atol=1e-6)